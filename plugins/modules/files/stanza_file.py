@@ -157,31 +157,160 @@ import os
 import re
 import tempfile
 import traceback
+from collections import OrderedDict
 
 from ansible.module_utils.basic import AnsibleModule
 from ansible.module_utils.common.text.converters import to_bytes, to_text
 
 
+ATTR_PATTERN = u'[#;]?[ \t]*(%s)[ \t]*(=|$)[ \t]*(.*)'
+ACTIVE_ATTR_PATTERN = u'[ \t]*(%s)[ \t]*(=|$)[ \t]*(.*)'
+
+
+def compile_attr_patterns(attr):
+    escaped_attr = re.escape(attr)
+    return re.compile(ATTR_PATTERN % escaped_attr), re.compile(ACTIVE_ATTR_PATTERN % escaped_attr)
+
+
 def match_attr(attr, line):
-    attr = re.escape(attr)
-    return re.match('[#;]?( |\t)*(%s)( |\t)*(=|$)( |\t)*(.*)' % attr, line)
+    return re.match(ATTR_PATTERN % re.escape(attr), line)
 
 
 def match_active_attr(attr, line):
-    attr = re.escape(attr)
-    return re.match('( |\t)*(%s)( |\t)*(=|$)( |\t)*(.*)' % attr, line)
+    return re.match(ACTIVE_ATTR_PATTERN % re.escape(attr), line)
+
+
+def is_blank_or_comment(line):
+    line = line.lstrip(u' \t\n')
+    return not line or line[0] in u'#;'
 
 
-def update_stanza_line(changed, stanza_lines, index, changed_lines, newline, msg):
+def update_stanza_line(changed, stanza_lines, index, changed_indices, newline, msg):
     attr_changed = stanza_lines[index] != newline
     changed = changed or attr_changed
     if attr_changed:
         msg = 'attr changed'
     stanza_lines[index] = newline
-    changed_lines[index] = 1
+    changed_indices.add(index)
     return (changed, msg)
 
 
+def update_present_stanza(stanza_lines, first_attr_index, attr, attr_re, active_attr_re, values,
+                          exclusive, allow_no_value, assignment_format, changed, msg):
+    # handling multiple instances of attr=value when state is 'present' with/without exclusive is a bit complex
+    #
+    # 1. edit all lines where we have a attr=value pair with a matching value in values[]
+    # 2. edit all the remaing lines where we have a matching attr
+    # 3. delete remaining lines where we have a matching attr
+    # 4. insert missing attr line(s) at the end of the stanza
+    #
+    # Only step 1 goes through the whole stanza. It cannot be merged with step 2, as a value
+    # may only be moved to another line once it is known that no line holds it already.
+    # Steps 2 and 3 only look at the attr lines found by step 1, and step 4 only walks back
+    # over the blank and comment lines at the end of the stanza.
+
+    # Keep track of the indexes of changed stanza_lines
+    changed_indices = set()
+    # indexes of all lines matching attr, commented out or not
+    attr_indexes = []
+    attr_no_value_present = False
+
+    for index, line in enumerate(stanza_lines):
+        match = attr in line and attr_re.match(line)
+        if match:
+            attr_indexes.append(index)
+            if values and match.group(3) in values:
+                matched_value = match.group(3)
+                if not matched_value and allow_no_value:
+                    # replace existing attr with no value line(s)
+                    newline = u'%s\n' % attr
+                    attr_no_value_present = True
+                else:
+                    # replace existing attr=value line(s)
+                    newline = assignment_format % (attr, matched_value)
+                (changed, msg) = update_stanza_line(changed, stanza_lines, index, changed_indices, newline, msg)
+                del values[matched_value]
+            elif not values and allow_no_value:
+                # replace existing attr with no value line(s)
+                newline = u'%s\n' % attr
+                (changed, msg) = update_stanza_line(changed, stanza_lines, index, changed_indices, newline, msg)
+                attr_no_value_present = True
+                break
+
+    if exclusive and not allow_no_value:
+        # all attr lines were found in step 1, only those it did not update are left to edit or delete
+        unchanged_attr_indexes = [index for index in attr_indexes if index not in changed_indices]
+        # override attr with no value to attr with value if not allow_no_value
+        if values:
+            for index in unchanged_attr_indexes:
+                if active_attr_re.match(stanza_lines[index]):
+                    newline = assignment_format % (attr, values.popitem(last=False)[0])
+                    (changed, msg) = update_stanza_line(changed, stanza_lines, index, changed_indices, newline, msg)
+                    if not values:
+                        break
+        # remove all remaining attr occurrences from the rest of the stanza
+        deleted_indexes = set(index for index in unchanged_attr_indexes
+                              if index >= first_attr_index and index not in changed_indices and active_attr_re.match(stanza_lines[index]))
+        if deleted_indexes:
+            stanza_lines = [line for index, line in enumerate(stanza_lines) if index not in deleted_indexes]
+            changed = True
+            msg = 'attr changed'
+
+    # insert missing attr line(s) at the end of the stanza
+    index = len(stanza_lines)
+    # search backwards for previous non-blank or non-comment line
+    while index > first_attr_index and is_blank_or_comment(stanza_lines[index - 1]):
+        index -= 1
+    pending_lines = []
+    if values:
+        # insert attr=value line(s)
+        pending_lines = [assignment_format % (attr, element) for element in values]
+    elif allow_no_value and not attr_no_value_present:
+        # insert attr with no value line(s)
+        pending_lines = [u'%s\n' % attr]
+    if pending_lines:
+        # only blank and comment lines follow the insertion point, so few lines have to move
+        stanza_lines[index:index] = pending_lines
+        msg = 'attr added'
+        changed = True
+
+    return (stanza_lines, changed, msg)
+
+
+def write_stanza_file(module, filename, stanza_lines, changed, backup, diff):
+    if module._diff and changed:
+        diff['after'] = u''.join(stanza_lines)
+    else:
+        # the file is left as it is
+        diff['after'] = diff['before']
+
+    backup_file = None
+    if changed and not module.check_mode:
+        if backup:
+            backup_file = module.backup_local(filename)
+
+        payload = to_bytes(u''.join(stanza_lines))
+        try:
+            tmpfd, tmpfile = tempfile.mkstemp(dir=module.tmpdir)
+            try:
+                # write to the descriptor directly, the payload is already one buffer; os.write()
+                # may still write less than asked for, so loop until everything is written
+                while payload:
+                    payload = payload[os.write(tmpfd, payload):]
+            finally:
+                os.close(tmpfd)
+        except (IOError, OSError):
+            module.fail_json(msg="Unable to create temporary file %s", traceback=traceback.format_exc())
+
+        try:
+            module.atomic_move(tmpfile, filename)
+        except IOError:
+            module.fail_json(msg='Unable to move temporary \
+                                   file %s to %s, IOError' % (tmpfile, filename), traceback=traceback.format_exc())
+
+    return backup_file
+
+
 def do_stanza(module, filename, stanza=None, attr=None, values=None,
               state='present', exclusive=True, backup=False, no_extra_spaces=False,
               create=True, allow_no_value=False):
@@ -190,11 +319,13 @@ def do_stanza(module, filename, stanza=None, attr=None, values=None,
         stanza = to_text(stanza)
     if attr is not None:
         attr = to_text(attr)
+        # attr is fixed for the whole run, so only compile its patterns once. Lines can only
+        # match them if they contain attr, so a cheap 'attr in line' check is done first to
+        # skip the regex engine for most lines.
+        attr_re, active_attr_re = compile_attr_patterns(attr)
 
-    # deduplicate entries in values
-    values_unique = []
-    [values_unique.append(to_text(value)) for value in values if value not in values_unique and value is not None]
-    values = values_unique
+    # deduplicate entries in values, keeping them ordered but with O(1) lookups and removals
+    values = OrderedDict.fromkeys(to_text(value) for value in values if value is not None)
 
     diff = dict(
         before='',
@@ -209,13 +340,17 @@ def do_stanza(module, filename, stanza=None, attr=None, values=None,
         destpath = os.path.dirname(filename)
         if not os.path.exists(destpath) and not module.check_mode:
             os.makedirs(destpath)
-        stanza_lines = []
+        stanza_data = u''
     else:
         with io.open(filename, 'r', encoding="utf-8-sig") as stanza_file:
-            stanza_lines = [to_text(line) for line in stanza_file.readlines()]
+            stanza_data = stanza_file.read()
+
+    # Line endings were already translated to '\n' while reading. Split on those only,
+    # str.splitlines() would also break lines on form feeds and other separators.
+    stanza_lines = io.StringIO(stanza_data).readlines()
 
     if module._diff:
-        diff['before'] = u''.join(stanza_lines)
+        diff['before'] = stanza_data
 
     changed = False
 
@@ -228,140 +363,78 @@ def do_stanza(module, filename, stanza=None, attr=None, values=None,
         stanza_lines[-1] += u'\n'
         changed = True
 
-    # append fake stanza lines to simplify the logic
-    # At top:
-    # Fake random stanza to do not match any other in the file
-    # Using commit hash as fake stanza name
-    fake_stanza_name = u"ad01e11446efb704fcdbdb21f2c43757423d91c5"
+    msg = 'OK'
+    stanza_header_prefix = u'[%s]' % stanza
 
-    # Insert it at the beginning
-    stanza_lines.insert(0, u'[%s]' % fake_section_name)
+    if state == 'present' and not attr:
+        # only the stanza header has to be present, there is no need to find the stanza boundaries
+        if stanza and not any(line.startswith(stanza_header_prefix) for line in stanza_lines):
+            stanza_lines.append(u'[%s]\n' % stanza)
+            msg = 'only stanza added'
+            changed = True
 
-    # At bottom:
-    stanza_lines.append(u'[')
+        backup_file = write_stanza_file(module, filename, stanza_lines, changed, backup, diff)
 
-    # If no stanza is defined, fake stanza is used
-    if not stanza:
-        stanza = fake_stanza_name
+        return (changed, backup_file, diff, msg)
 
+    # If no stanza is defined, the attrs live before the first stanza of the file.
+    # That part has no stanza header line, so its attr lines start at index 0 instead of 1.
     within_stanza = not stanza
-    stanza_start = stanza_end = 0
-    msg = 'OK'
+    first_attr_index = 1 if stanza else 0
+    # -1 marks a boundary that has not been found (yet)
+    stanza_start = 0 if within_stanza else -1
+    stanza_end = -1
     if no_extra_spaces:
         assignment_format = u'%s=%s\n'
     else:
         assignment_format = u'%s = %s\n'
 
-    attr_no_value_present = False
-
-    non_blank_non_comment_pattern = re.compile(to_text(r'^[ \t]*([#;].*)?$'))
-
-    before = after = []
-    stanza_lines = []
-
-    for index, line in enumerate(stanza_lines):
-        # find start and end of stanza
-        if line.startswith(u'[%s]' % stanza):
+    # find start and end of stanza, only header lines can be either of them
+    header_indexes = (index for index, line in enumerate(stanza_lines) if line.startswith(u'['))
+    for index in header_indexes:
+        if stanza and stanza_lines[index].startswith(stanza_header_prefix):
             within_stanza = True
             stanza_start = index
-        elif line.startswith(u'['):
-            if within_stanza:
-                stanza_end = index
-                break
+        elif within_stanza:
+            stanza_end = index
+            break
 
-    before = stanza_lines[0:stanza_start]
-    stanza_lines = stanza_lines[stanza_start:stanza_end]
-    after = stanza_lines[stanza_end:len(stanza_lines)]
+    if stanza_end == -1:
+        # the stanza runs up to the end of the file
+        stanza_end = len(stanza_lines)
+    if stanza_start == -1:
+        # the stanza is missing, it is added at the end of the file
+        stanza_start = stanza_end
 
-    # Keep track of changed stanza_lines
-    changed_lines = [0] * len(stanza_lines)
+    # only copy the lines of the stanza itself, the rest of the file is left untouched
+    file_lines = stanza_lines
+    stanza_lines = file_lines[stanza_start:stanza_end]
 
-    # handling multiple instances of attr=value when state is 'present' with/without exclusive is a bit complex
-    #
-    # 1. edit all lines where we have a attr=value pair with a matching value in values[]
-    # 2. edit all the remaing lines where we have a matching attr
-    # 3. delete remaining lines where we have a matching attr
-    # 4. insert missing attr line(s) at the end of the stanza
-
-    if state == 'present' and attr:
-        for index, line in enumerate(stanza_lines):
-            if match_attr(attr, line):
-                match = match_attr(attr, line)
-                if values and match.group(6) in values:
-                    matched_value = match.group(6)
-                    if not matched_value and allow_no_value:
-                        # replace existing attr with no value line(s)
-                        newline = u'%s\n' % attr
-                        attr_no_value_present = True
-                    else:
-                        # replace existing attr=value line(s)
-                        newline = assignment_format % (attr, matched_value)
-                    (changed, msg) = update_stanza_line(changed, stanza_lines, index, changed_lines, newline, msg)
-                    values.remove(matched_value)
-                elif not values and allow_no_value:
-                    # replace existing attr with no value line(s)
-                    newline = u'%s\n' % attr
-                    (changed, msg) = update_stanza_line(changed, stanza_lines, index, changed_lines, newline, msg)
-                    attr_no_value_present = True
-                    break
-
-    if state == 'present' and exclusive and not allow_no_value:
-        # override attr with no value to attr with value if not allow_no_value
-        if len(values) > 0:
-            for index, line in enumerate(stanza_lines):
-                if not changed_lines[index] and match_active_attr(attr, stanza_lines[index]):
-                    newline = assignment_format % (attr, values.pop(0))
-                    (changed, msg) = update_stanza_line(changed, stanza_lines, index, changed_lines, newline, msg)
-                    if len(values) == 0:
-                        break
-        # remove all remaining attr occurrences from the rest of the stanza
-        for index in range(len(stanza_lines) - 1, 0, -1):
-            if not changed_lines[index] and match_active_attr(attr, stanza_lines[index]):
-                del stanza_lines[index]
-                del changed_lines[index]
-                changed = True
-                msg = 'attr changed'
-
-    if state == 'present':
-        # insert missing attr line(s) at the end of the stanza
-        for index in range(len(stanza_lines), 0, -1):
-            # search backwards for previous non-blank or non-comment line
-            if not non_blank_non_comment_pattern.match(stanza_lines[index - 1]):
-                if attr and values:
-                    # insert attr line(s)
-                    for element in values[::-1]:
-                        # items are added backwards, so traverse the list backwards to not confuse the user
-                        # otherwise some of their attrs might appear in reverse order for whatever fancy reason ¯\_(ツ)_/¯
-                        if element is not None:
-                            # insert attr=value line
-                            stanza_lines.insert(index, assignment_format % (attr, element))
-                            msg = 'attr added'
-                            changed = True
-                        elif element is None and allow_no_value:
-                            # insert attr with no value line
-                            stanza_lines.insert(index, u'%s\n' % attr)
-                            msg = 'attr added'
-                            changed = True
-                elif attr and not values and allow_no_value and not attr_no_value_present:
-                    # insert attr with no value line(s)
-                    stanza_lines.insert(index, u'%s\n' % attr)
-                    msg = 'attr added'
-                    changed = True
-                break
+    if state == 'present' and within_stanza:
+        (stanza_lines, changed, msg) = update_present_stanza(stanza_lines, first_attr_index, attr, attr_re, active_attr_re, values,
+                                                             exclusive, allow_no_value, assignment_format, changed, msg)
 
     if state == 'absent':
         if attr:
             if exclusive:
                 # delete all attr line(s) with given attr and ignore value
-                new_stanza_lines = [line for line in stanza_lines if not (match_active_attr(attr, line))]
-                if stanza_lines != new_stanza_lines:
+                new_stanza_lines = [line for line in stanza_lines if not (attr in line and active_attr_re.match(line))]
+                # lines are only ever dropped, so comparing the lengths is enough
+                if len(stanza_lines) != len(new_stanza_lines):
                     changed = True
                     msg = 'attr changed'
                     stanza_lines = new_stanza_lines
             elif not exclusive and len(values) > 0:
                 # delete specified attr=value line(s)
-                new_stanza_lines = [i for i in stanza_lines if not (match_active_attr(attr, i) and match_active_attr(attr, i).group(6) in values)]
-                if stanza_lines != new_stanza_lines:
+                new_stanza_lines = []
+                modified = False
+                for line in stanza_lines:
+                    match = attr in line and active_attr_re.match(line)
+                    if match and match.group(3) in values:
+                        modified = True
+                        continue
+                    new_stanza_lines.append(line)
+                if modified:
                     changed = True
                     msg = 'attr changed'
                     stanza_lines = new_stanza_lines
@@ -372,12 +445,9 @@ def do_stanza(module, filename, stanza=None, attr=None, values=None,
                 msg = 'stanza removed'
                 changed = True
 
-    # reassemble the stanza_lines after manipulation
-    stanza_lines = before + stanza_lines + after
-
-    # remove the fake stanza line
-    del stanza_lines[0]
-    del stanza_lines[-1:]
+    # put the stanza back in place after manipulation
+    file_lines[stanza_start:stanza_end] = stanza_lines
+    stanza_lines = file_lines
 
     if not within_stanza and state == 'present':
         stanza_lines.append(u'[%s]\n' % stanza)
@@ -391,28 +461,7 @@ def do_stanza(module, filename, stanza=None, attr=None, values=None,
             msg = 'only stanza added'
         changed = True
 
-    if module._diff:
-        diff['after'] = u''.join(stanza_lines)
-
-    backup_file = None
-    if changed and not module.check_mode:
-        if backup:
-            backup_file = module.backup_local(filename)
-
-        encoded_stanza_lines = [to_bytes(line) for line in stanza_lines]
-        try:
-            tmpfd, tmpfile = tempfile.mkstemp(dir=module.tmpdir)
-            f = os.fdopen(tmpfd, 'wb')
-            f.writelines(encoded_stanza_lines)
-            f.close()
-        except IOError:
-            module.fail_json(msg="Unable to create temporary file %s", traceback=traceback.format_exc())
-
-        try:
-            module.atomic_move(tmpfile, filename)
-        except IOError:
-            module.ansible.fail_json(msg='Unable to move temporary \
-                                   file %s to %s, IOError' % (tmpfile, filename), traceback=traceback.format_exc())
+    backup_file = write_stanza_file(module, filename, stanza_lines, changed, backup, diff)
 
     return (changed, backup_file, diff, msg)
 